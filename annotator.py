@@ -1,8 +1,186 @@
-from openai import OpenAI
-import xml.etree.ElementTree as ET
+from openai import OpenAI, AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError, ConflictError
+from tenacity import retry, wait_random_exponential, stop_after_attempt, retry_if_exception_type
+from rate_limiter import RateLimiter
+from lxml import etree as ET
+from collections import defaultdict
+import asyncio
+import hashlib
+import httpx
+import importlib.util
 import json
 import os
+import tempfile
+import time
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# HTTP/2 needs the optional `h2` package (`pip install httpx[http2]`), otherwise fall back to HTTP/1.1
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+
+CATEGORY_DEFINITIONS = (
+    "- **Historical Arguments**: Interpretation based on the original intentions of the framers and ratifiers.\n"
+    "- **Textual Arguments**: Based solely on the literal meaning of the words.\n"
+    "- **Structural Arguments**: Analysis of the overall constitutional system and interactions among its parts.\n"
+    "- **Prudential Arguments**: Evaluation of practical pros and cons and social consequences.\n"
+    "- **Doctrinal Arguments**: Use of legal precedents to resolve new cases.\n"
+    "- **Ethical Arguments**: Based on moral principles and shared societal values.\n\n"
+)
+
+# part of the on-disk cache key: bump it whenever the prompts or the output schemas change,
+# so that results produced with the old ones are not reused
+PROMPT_VERSION = "1"
+
+# system prompts are kept byte-identical across requests so that they hit OpenAI's prompt cache;
+# everything that varies (sentences, group ids) goes in the user message
+SYSTEM_PROMPT_GROUPS = (
+    "You are an assistant skilled in the structural and semantic analysis of legal sentences. "
+    "You will receive sentences annotated with an ID and various attributes. "
+    "Your task is to group the sentences that share a common semantic logic or address the same topic.\n\n"
+    "Follow these **strict guidelines** when grouping the sentences:\n"
+    "1. **Do not exceed 7/8 sentences per group**: Under no circumstances should a group contain more than 8 sentences.\n"
+    "2. **Group by semantic meaning**: Ignore the IDs and order. Base the grouping purely on the meaning of each sentence.\n"
+    "3. **Leave unrelated sentences ungrouped**: Assign them to `group_id: null` with an explanation.\n"
+    "4. **Provide clear reasons for grouping**: Explain why sentences are grouped together, focusing on their shared logic or theme.\n\n"
+    "Format the response strictly as JSON:\n"
+    "{\n"
+    "  \"groups\": [\n"
+    "    {\n"
+    "      \"group_id\": 1,\n"
+    "      \"sentence_ids\": [\"ID1\", \"ID2\", \"ID3\"],\n"
+    "      \"reason\": \"Explanation for why these sentences are grouped together.\"\n"
+    "    },\n"
+    "    {\n"
+    "      \"group_id\": 2,\n"
+    "      \"sentence_ids\": [\"ID4\", \"ID5\"],\n"
+    "      \"reason\": \"Explanation for this grouping.\"\n"
+    "    },\n"
+    "    {\n"
+    "      \"group_id\": null,\n"
+    "      \"sentence_ids\": [\"ID8\", \"ID20\"],\n"
+    "      \"reason\": \"Ungrouped sentences due to lack of thematic connection.\"\n"
+    "    }\n"
+    "  ]\n"
+    "}\n"
+)
+
+SYSTEM_PROMPT_ANNOTATIONS = (
+    "You are an expert assistant in analyzing legal texts. "
+    "Your task is to classify a supporting argument into one of the following subcategories, "
+    "or to indicate that none is appropriate: \n"
+    f"{CATEGORY_DEFINITIONS}"
+    "If none of the categories is suitable, you may indicate that the text does not fit into any of them.\n\n"
+    "Please return the result in the following JSON format:\n\n"
+    "{\n"
+    "   \"Group\": \"[Group id, exactly as given]\",\n"
+    "   \"Category\": \"[Name of Category or 'None']\",\n"
+    "   \"Reason\": \"[Explanation for the classification]\"\n"
+    "}\n"
+)
+
+SYSTEM_PROMPT_PACKED_ANNOTATIONS = (
+    "You are an expert assistant in analyzing legal texts. "
+    "Your task is to classify each supporting argument into one of the following subcategories, "
+    "or to indicate that none is appropriate: \n"
+    f"{CATEGORY_DEFINITIONS}"
+    "If none of the categories is suitable, you may indicate that the text does not fit into any of them.\n\n"
+    "Please return the result in the following JSON format, with one object per group:\n\n"
+    "{\n"
+    "  \"groups\": [\n"
+    "    {\n"
+    "      \"Group\": \"[Group id, exactly as given]\",\n"
+    "      \"Category\": \"[Name of Category or 'None']\",\n"
+    "      \"Reason\": \"[Explanation for the classification]\"\n"
+    "    }\n"
+    "  ]\n"
+    "}\n"
+)
+
+# structured output schemas, so that the API only returns valid JSON of the expected shape
+GROUPS_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "groups",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "groups": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "group_id": {"type": ["integer", "null"]},
+                            "sentence_ids": {"type": "array", "items": {"type": "string"}},
+                            "reason": {"type": "string"}
+                        },
+                        "required": ["group_id", "sentence_ids", "reason"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["groups"],
+            "additionalProperties": False
+        }
+    }
+}
+
+ANNOTATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "Group": {"type": "string"},
+        "Category": {
+            "type": "string",
+            "enum": [
+                "Historical Arguments",
+                "Textual Arguments",
+                "Structural Arguments",
+                "Prudential Arguments",
+                "Doctrinal Arguments",
+                "Ethical Arguments",
+                "None"
+            ]
+        },
+        "Reason": {"type": "string"}
+    },
+    "required": ["Group", "Category", "Reason"],
+    "additionalProperties": False
+}
+
+ANNOTATION_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "annotation", "strict": True, "schema": ANNOTATION_SCHEMA}
+}
+
+PACKED_ANNOTATIONS_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "annotations",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"groups": {"type": "array", "items": ANNOTATION_SCHEMA}},
+            "required": ["groups"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# keep-alive pool shared by all the requests of an annotator; with HTTP/2 (if `h2` is installed)
+# concurrent requests are multiplexed on the same TCP+TLS connection
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=50, max_connections=100)
 
+# retries transient API failures (429, 409, 5xx, timeouts and connection errors) with random exponential backoff;
+# the SDK clients are built with `max_retries=0`, so this is the only retry policy
+api_retry = retry(
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError, InternalServerError, ConflictError)),
+    reraise=True
+)
 
 
 class AddAnnotations:
@@ -19,18 +197,258 @@ class AddAnnotations:
     Main Methods:
     - unified_struct: Groups sentences based on semantic logic.
     - parse_json_output: Validates and unifies API JSON responses.
+    - save_json: Saves the unified JSON responses to disk.
     - annotations: Categorizes sentence groups and updates XML.
+    - annotations_batch: Same as `annotations`, but through the OpenAI Batch API.
     - call_unifypar_struct & call_annotations: Orchestrate the grouping and annotation processes.
 
+    Group classification packs up to `groups_per_request` groups (and at most `max_prompt_tokens` tokens) 
+    into a single chat request; requests are sent concurrently through an async client, 
+    bounded by `max_concurrency` simultaneous requests.
+    Every chat request is throttled to `max_requests_per_minute` / `max_tokens_per_minute` 
+    and retried with exponential backoff on rate-limit and connection errors.
+    Chat requests reuse the keep-alive connections of one async client, kept on the annotator's own event loop 
+    across steps and files (so an annotator is used by one thread at a time); the Batch API uses the sync 
+    `http_client`. Use the annotator as a context manager (or call `close`) to release them.
+    Grouping and classification results are cached in `cache_dir`, keyed on the content of the input XML, 
+    the model, `PROMPT_VERSION` and the chunking settings, so that reruns on the same files do not call the API again.
+    An optional `SemanticCache` (see `semantic_cache.py`) skips the request for groups similar to already classified ones.
+
     Efficiently prepares legal datasets for further analysis or presentation.
     """
 
 
-    def __init__(self, model_name='gpt-4o-mini', max_tokens=2000, openai_api_key=None):
+    # abbreviated names written in the `Category` attribute
+    CATEGORY_MAP = {
+        "Historical Arguments": "HIS",
+        "Textual Arguments": "TXT",
+        "Structural Arguments": "STRUCT",
+        "Prudential Arguments": "PRUD",
+        "Doctrinal Arguments": "DOCT",
+        "Ethical Arguments": "ETH",
+        "None": "None"
+    }
+
+    # compiled once, the tag/attribute filtering runs in C instead of a Python loop over every node
+    _ID_XPATH = ET.XPath(".//*[@ID and local-name() != 'body']")
+    _GROUP_XPATH = ET.XPath(".//*[@Group]")
+
+    def __init__(self, model_name='gpt-4o-mini', max_tokens=2000, openai_api_key=None, max_concurrency=20,
+                 groups_per_request=10, max_prompt_tokens=6000, semantic_cache=None,
+                 max_requests_per_minute=500, max_tokens_per_minute=200000, rate_limiter=None, http_client=None,
+                 cache_dir='.cache'):
         self.model_name = model_name
+        # model outputs are cached per document content, set `cache_dir=None` to always call the API
+        self.cache_dir = cache_dir
+        self.openai_api_key = openai_api_key
+        # a shared `rate_limiter` keeps several annotators (e.g. one per thread) under the same account limits
+        self.rate_limiter = rate_limiter or RateLimiter(max_requests_per_minute, max_tokens_per_minute)
+        self.semantic_cache = semantic_cache
         self.max_tokens = max_tokens
-        if openai_api_key:
-            self.client = OpenAI(api_key=openai_api_key)
+        self.max_concurrency = max_concurrency
+        self.groups_per_request = groups_per_request
+        self.max_prompt_tokens = max_prompt_tokens
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                try:
+                    self.encoding = tiktoken.encoding_for_model(model_name)
+                except KeyError:
+                    self.encoding = tiktoken.get_encoding('o200k_base')
+            except Exception as e:
+                # the BPE file is downloaded on first use, offline we fall back to the character-based estimate
+                print(f"tiktoken non disponibile ({e}), uso una stima dei token.")
+                self.encoding = None
+        # sync pool, used by the Batch API; a caller-provided `http_client` is shared with other annotators and is not closed by `close`
+        self._owns_http = http_client is None
+        self._http = http_client or httpx.Client(http2=HTTP2, timeout=60, limits=HTTP_LIMITS)
+        # chat requests go through the async client, created on first use on the annotator's own event loop
+        self._loop = None
+        self._ahttp = None
+        self.aclient = None
+        # sync client, used by the Batch API, created on first use like the async one; without `openai_api_key` 
+        # both fall back to the OPENAI_API_KEY environment variable
+        self.client = None
+
+    def close(self):
+        """
+        Closes the async client with its event loop, and the sync HTTP connection pool unless it was provided by the caller.
+        """
+
+        if self._loop is not None:
+            if self._ahttp is not None:
+                self._loop.run_until_complete(self._ahttp.aclose())
+            self._loop.close()
+            self._loop, self._ahttp, self.aclient = None, None, None
+        if self._owns_http:
+            self._http.close()
+
+    def _run(self, coroutine):
+        """
+        Runs `coroutine` on the annotator's event loop. The loop is kept between calls, so that the async client 
+        and its keep-alive connections are reused by every step and file processed by this annotator.
+        An annotator must therefore be used by one thread at a time.
+        """
+
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(coroutine)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _prompt_tokens(self, messaggi):
+        return sum(self._count_tokens(messaggio["content"]) for messaggio in messaggi)
+
+    @staticmethod
+    @api_retry
+    def _api_call(method, *args, **kwargs):
+        """
+        Calls a sync client `method` (used for the Batch API endpoints), retrying on transient errors.
+        """
+
+        return method(*args, **kwargs)
+
+    @api_retry
+    async def _achat_with_retry(self, **kwargs):
+        """
+        Sends a chat completion request with the async client, waiting for the rate limiter first 
+        and retrying on rate-limit and connection errors. Takes the same arguments as `chat.completions.create`.
+        """
+
+        await self.rate_limiter.acquire_async(self._prompt_tokens(kwargs["messages"]))
+        raw = await self.aclient.chat.completions.with_raw_response.create(**kwargs)
+        self.rate_limiter.update_from_headers(raw.headers)
+        return raw.parse()
+
+    def _cache_key(self, kind, element):
+        """
+        Returns the key of the on-disk cache for the `kind` step ('groups' or 'annotations') of a document: 
+        the SHA-256 of the serialized XML `element`, the model name, `PROMPT_VERSION` and the chunking settings 
+        (`max_prompt_tokens`, `groups_per_request`), which change how sentences and groups are split across requests.
+        """
+
+        digest = hashlib.sha256(ET.tostring(element))
+        digest.update(self.model_name.encode())
+        digest.update(PROMPT_VERSION.encode())
+        digest.update(kind.encode())
+        digest.update(f'{self.max_prompt_tokens}:{self.groups_per_request}'.encode())
+        return digest.hexdigest()
+
+    def _load_cached(self, key):
+        """
+        Returns the model output cached under `key`, or `None` if caching is disabled or there is no entry.
+        """
+
+        if self.cache_dir is None:
+            return None
+        cache_path = os.path.join(self.cache_dir, f'{key}.json')
+        if not os.path.exists(cache_path):
+            return None
+        with open(cache_path, encoding="utf-8") as f:
+            print(f"Risultato trovato nella cache: {cache_path}")
+            return json.load(f)
+
+    def _save_cached(self, key, data):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, f'{key}.json'), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    def _grouping_messages(self, lista):
+        """
+        Builds the chat messages asking the model to group the sentences in `lista` by semantic meaning.
+        """
+
+        messaggi = [
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT_GROUPS
+            },
+            {
+                "role": "user",
+                "content": (
+                    "Here are some legal sentences annotated with IDs:\n\n"
+                    f"{json.dumps(lista, ensure_ascii=False)}\n\n"
+                    "Please strictly adhere to the guidelines "
+                    "Group unrelated sentences under `group_id: null`. Provide clear reasons for each group."
+                )
+            }
+        ]
+        return messaggi
+
+    def _chunk_sentences(self, lista):
+        """
+        Splits the sentences into consecutive chunks of at most `max_prompt_tokens` tokens, 
+        so that long documents do not overflow the context window of a single request.
+        A single sentence larger than the budget is sent alone.
+        """
+
+        chunks = []
+        chunk, chunk_tokens = [], 0
+        for item in lista:
+            tokens = self._count_tokens(json.dumps(item, ensure_ascii=False))
+            if chunk and chunk_tokens + tokens > self.max_prompt_tokens:
+                chunks.append(chunk)
+                chunk, chunk_tokens = [], 0
+            chunk.append(item)
+            chunk_tokens += tokens
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    async def _group_chunk(self, chunk_idx, chunk, sem):
+        """
+        Groups the sentences of one chunk with a single request to the async client.
+        Group ids are renumbered as `chunk_idx * 1000 + group_id` so that they do not collide across chunks.
+
+        Returns the list of groups, or `None` if the response could not be parsed.
+        """
+
+        async with sem:
+            risposta = await self._achat_with_retry(
+                model=self.model_name,
+                messages=self._grouping_messages(chunk),
+                temperature=0.2,
+                response_format=GROUPS_FORMAT
+            )
+        contenuto_risposta = risposta.choices[0].message.content.strip()
+
+        try:
+            groups = json.loads(contenuto_risposta)["groups"]
+        except (json.JSONDecodeError, KeyError) as e:
+            print(f"Errore nel parsing del JSON: {e}")
+            print("Contenuto grezzo:", contenuto_risposta)
+            return None
+
+        for group in groups:
+            if group['group_id'] is not None:
+                group['group_id'] = chunk_idx * 1000 + group['group_id']
+        return groups
+
+    async def _gather(self, make_tasks):
+        """
+        Runs the coroutines returned by `make_tasks(sem)` concurrently and returns their results in order.
+        `sem` bounds the requests in flight to `max_concurrency`. The async client is created on the first call 
+        and reused afterwards (see `_run`).
+        If a task fails, the others are cancelled before the first error is raised, so that no request is left 
+        pending on the annotator's event loop for the next file.
+        """
+
+        if self.aclient is None:
+            self._ahttp = httpx.AsyncClient(http2=HTTP2, timeout=60, limits=HTTP_LIMITS)
+            self.aclient = AsyncOpenAI(api_key=self.openai_api_key, http_client=self._ahttp, max_retries=0)
+        sem = asyncio.Semaphore(self.max_concurrency)
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                tasks = [task_group.create_task(coroutine) for coroutine in make_tasks(sem)]
+        except ExceptionGroup as eg:
+            raise eg.exceptions[0] from eg
+        return [task.result() for task in tasks]
 
     def unified_struct(self, element, output_json, name):
         """
@@ -38,8 +456,9 @@ class AddAnnotations:
         It utilizes an AI model to cluster sentences into groups with clear reasoning for each grouping.
 
         Steps:
-        1. Extracts sentences from the XML `element`, skipping those with the tag 'body'.
-        2. Sends sentences to an AI model for semantic grouping, adhering to strict guidelines:
+        1. Extracts sentences (elements with an `ID`) from the XML `element`, skipping those with the tag 'body'.
+        2. Sends sentences to an AI model for semantic grouping, in chunks of at most `max_prompt_tokens` tokens 
+        processed concurrently (group ids are renumbered per chunk), adhering to strict guidelines:
         - Groups must have a maximum of 7-8 sentences.
         - Sentences with no clear thematic connection are assigned `group_id: null`.
         3. Parses the AI response and maps each sentence to its assigned group.
@@ -56,79 +475,38 @@ class AddAnnotations:
         """
 
         lista = []
-        for i, elem in enumerate(element.iter()):
-            if elem.tag != 'body':
-                lista.append({'ID': elem.attrib.get('ID', f'ID{i}'), 'attrib': elem.attrib, 'text': elem.text})
+        id_index = {}
+        for elem in self._ID_XPATH(element):
+            elem_id = elem.attrib['ID']
+            lista.append({'ID': elem_id, 'attrib': dict(elem.attrib), 'text': elem.text})
+            id_index[elem_id] = elem
+
+        cache_key = self._cache_key('groups', element)
+        output_file = self._load_cached(cache_key)
+        if output_file is None:
+            groups = self._run(self._gather(lambda sem: [
+                self._group_chunk(chunk_idx, chunk, sem) for chunk_idx, chunk in enumerate(self._chunk_sentences(lista))
+            ]))
 
-        messaggi = [
-            {
-                "role": "system",
-                "content": (
-                    "You are an assistant skilled in the structural and semantic analysis of legal sentences. "
-                    "You will receive sentences annotated with an ID and various attributes. "
-                    "Your task is to group the sentences that share a common semantic logic or address the same topic.\n\n"
-                    "Follow these **strict guidelines** when grouping the sentences:\n"
-                    "1. **Do not exceed 7/8 sentences per group**: Under no circumstances should a group contain more than 8 sentences.\n"
-                    "2. **Group by semantic meaning**: Ignore the IDs and order. Base the grouping purely on the meaning of each sentence.\n"
-                    "3. **Leave unrelated sentences ungrouped**: Assign them to `group_id: null` with an explanation.\n"
-                    "4. **Provide clear reasons for grouping**: Explain why sentences are grouped together, focusing on their shared logic or theme.\n\n"
-                    "Format the response strictly as JSON:\n"
-                    "{\n"
-                    "  \"groups\": [\n"
-                    "    {\n"
-                    "      \"group_id\": 1,\n"
-                    "      \"sentence_ids\": [\"ID1\", \"ID2\", \"ID3\"],\n"
-                    "      \"reason\": \"Explanation for why these sentences are grouped together.\"\n"
-                    "    },\n"
-                    "    {\n"
-                    "      \"group_id\": 2,\n"
-                    "      \"sentence_ids\": [\"ID4\", \"ID5\"],\n"
-                    "      \"reason\": \"Explanation for this grouping.\"\n"
-                    "    },\n"
-                    "    {\n"
-                    "      \"group_id\": null,\n"
-                    "      \"sentence_ids\": [\"ID8\", \"ID20\"],\n"
-                    "      \"reason\": \"Ungrouped sentences due to lack of thematic connection.\"\n"
-                    "    }\n"
-                    "  ]\n"
-                    "}\n"
-                )
-            },
-            {
-                "role": "user",
-                "content": (
-                    "Here are some legal sentences annotated with IDs:\n\n"
-                    f"{json.dumps(lista, indent=2)}\n\n"
-                    "Please strictly adhere to the guidelines "
-                    "Group unrelated sentences under `group_id: null`. Provide clear reasons for each group."
-                )
-            }
-        ]
+            if any(chunk_groups is None for chunk_groups in groups):
+                print("Errore: Impossibile elaborare l'output JSON.")
+                return
 
-        risposta = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=messaggi,
-            temperature=0.2
-        )
-        contenuto_risposta = risposta.choices[0].message.content.strip()
+            output_file = {"groups": [group for chunk_groups in groups for group in chunk_groups]}
+            self._save_cached(cache_key, output_file)
 
-        output_file, unified_json = self.parse_json_output(contenuto_risposta=contenuto_risposta, unified_json=None, file_path=output_json)
-        if output_file is None:
-            print("Errore: Impossibile elaborare l'output JSON.")
-            return
+        self.save_json({"groups": [output_file]}, output_json)
 
        
         group_map = {item_id: group['group_id'] for group in output_file['groups'] for item_id in group['sentence_ids']}
 
         print(group_map)
-        for elem in element.iter():
-            if elem.tag != 'body' and 'ID' in elem.attrib:
-                elem_id = elem.attrib['ID']
-                if elem_id in group_map:
-                    elem.set('Group', str(group_map[elem_id]))
+        for elem_id, group_id in group_map.items():
+            if elem_id in id_index:
+                id_index[elem_id].set('Group', str(group_id))
 
        
-        tree = ET.ElementTree(element)
+        tree = element.getroottree()
         output_directory = 'demosthenes_dataset_group'
         os.makedirs(output_directory, exist_ok=True)
 
@@ -137,23 +515,24 @@ class AddAnnotations:
 
 
 
-    def parse_json_output(self, contenuto_risposta, unified_json=None, file_path="output.json"):
+    def parse_json_output(self, contenuto_risposta, unified_json=None, file_path="output.json", flush=True):
         """
         This method processes raw JSON-like responses, validates their structure, 
         integrates them into a unified JSON object, and saves the result to a specified file.
 
         Steps:
         1. **Initialization**: Initializes `unified_json` if not provided, starting with an empty "groups" list.
-        2. **Formatting Cleanup**: Removes Markdown-style delimiters (e.g., ```json```) and unescapes quotes in the response string.
-        3. **Parsing**: Attempts to parse the cleaned string into a JSON object. If parsing fails, logs the error and returns the existing `unified_json` unchanged.
-        4. **Integration**: Appends the parsed response to the "groups" list in `unified_json`.
-        5. **File Saving**: Ensures the directory exists and saves the updated `unified_json` to the specified `file_path` in a human-readable format.
-        6. **Error Handling**: Catches and logs any generic exceptions, returning `None` for the response JSON while preserving the existing `unified_json`.
+        2. **Parsing**: Attempts to parse the response string (requested with a JSON schema, so no Markdown cleanup is needed) into a JSON object. If parsing fails, logs the error and returns the existing `unified_json` unchanged.
+        3. **Integration**: Appends the parsed response to the "groups" list in `unified_json`.
+        4. **File Saving**: If `flush` is True, saves the updated `unified_json` to the specified `file_path` (see `save_json`).
+        When parsing many responses in a loop, pass `flush=False` and call `save_json` once at the end.
+        5. **Error Handling**: Catches and logs any generic exceptions, returning `None` for the response JSON while preserving the existing `unified_json`.
 
         Inputs:
         - `contenuto_risposta` (str): The raw response string that resembles JSON.
         - `unified_json` (dict, optional): The cumulative JSON object to which new data is appended.
         - `file_path` (str): The file path where the updated JSON object is saved.
+        - `flush` (bool): Whether to save `unified_json` to `file_path` after integrating the response.
 
         Outputs:
         - `response_json` (dict): The parsed JSON object from the current response.
@@ -166,11 +545,6 @@ class AddAnnotations:
             if unified_json is None:
                 unified_json = {"groups": []}
 
-            contenuto_risposta = contenuto_risposta.strip()
-            if contenuto_risposta.startswith('```json') and contenuto_risposta.endswith('```'):
-                contenuto_risposta = contenuto_risposta[7:-3].strip()
-            contenuto_risposta = contenuto_risposta.replace('\\"', '"')
-
             try:
                 response_json = json.loads(contenuto_risposta)
             except json.JSONDecodeError as e:
@@ -179,11 +553,8 @@ class AddAnnotations:
                 return None, unified_json
             
             unified_json["groups"].append(response_json)
-            output_directory = os.path.dirname(file_path)
-            os.makedirs(output_directory, exist_ok=True)
-            with open(file_path, "w", encoding="utf-8") as json_file:
-                json.dump(unified_json, json_file, indent=4, ensure_ascii=False)
-            print(f"JSON salvato con successo in {file_path}")
+            if flush:
+                self.save_json(unified_json, file_path)
 
             return response_json, unified_json
 
@@ -191,6 +562,191 @@ class AddAnnotations:
             print(f"Errore generico: {e}")
             return None, unified_json
 
+    def save_json(self, unified_json, file_path):
+        """
+        Saves `unified_json` to `file_path` in a human-readable format, creating the directory if needed.
+        """
+
+        output_directory = os.path.dirname(file_path)
+        os.makedirs(output_directory, exist_ok=True)
+        with open(file_path, "w", encoding="utf-8") as json_file:
+            json.dump(unified_json, json_file, indent=4, ensure_ascii=False)
+        print(f"JSON salvato con successo in {file_path}")
+
+    def _annotation_messages(self, group, text):
+        """
+        Builds the chat messages asking the model to classify the aggregated `text` of `group` 
+        into one of the argument categories.
+        """
+
+        messaggi = [
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT_ANNOTATIONS
+            },
+            {
+                "role": "user",
+                "content": (
+                    f"The following text is a supporting argument: {text}. "
+                    f"Group: {group}. "
+                    "Analyze the content and identify the most relevant subcategory from the provided options, "
+                    "or indicate if none of the subcategories is appropriate. "
+                    "Please ensure the response is formatted strictly as JSON, following the example provided."
+                )
+            }
+        ]
+        return messaggi
+
+    def _packed_annotation_messages(self, chunk):
+        """
+        Builds the chat messages asking the model to classify several groups at once.
+        `chunk` is a list of `(group, text)` pairs; the model answers with one object per group.
+        """
+
+        messaggi = [
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT_PACKED_ANNOTATIONS
+            },
+            {
+                "role": "user",
+                "content": (
+                    "Classify each of the following groups. Return a JSON object whose `groups` list contains one object per group, "
+                    "with the group id exactly as given.\n\n"
+                    f"{json.dumps([{'group': group, 'text': text} for group, text in chunk], ensure_ascii=False)}"
+                )
+            }
+        ]
+        return messaggi
+
+    def _count_tokens(self, text):
+        """
+        Returns the number of tokens of `text` for the configured model.
+        Falls back to a rough estimate (4 characters per token) when `tiktoken` is not installed or its encoding cannot be loaded.
+        """
+
+        if self.encoding is None:
+            return len(text) // 4 + 1
+        return len(self.encoding.encode(text))
+
+    def _chunk_groups(self, diz_groups):
+        """
+        Splits the groups into chunks of at most `groups_per_request` groups 
+        whose texts add up to at most `max_prompt_tokens` tokens.
+        A single group larger than the budget is sent alone.
+        """
+
+        chunks = []
+        chunk, chunk_tokens = [], 0
+        for group, text in diz_groups.items():
+            tokens = self._count_tokens(text)
+            if chunk and (len(chunk) >= self.groups_per_request or chunk_tokens + tokens > self.max_prompt_tokens):
+                chunks.append(chunk)
+                chunk, chunk_tokens = [], 0
+            chunk.append((group, text))
+            chunk_tokens += tokens
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    async def _classify_chunk(self, chunk, sem):
+        """
+        Classifies a chunk of groups with a single request to the async client.
+        The semaphore `sem` bounds how many requests are in flight at the same time.
+
+        The objects returned by the model are matched to the groups that were sent by their (normalized) 
+        group id, or by position when the id is not recognized. Groups left without a classification are 
+        logged and requested again one by one with `_classify_single`.
+
+        Returns the list of `{Group, Category, Reason}` objects, in the order of `chunk`.
+        """
+
+        messaggi = self._packed_annotation_messages(chunk)
+
+        async with sem:
+            risposta = await self._achat_with_retry(
+                model=self.model_name,
+                messages=messaggi,
+                temperature=0.2,
+                response_format=PACKED_ANNOTATIONS_FORMAT
+            )
+        contenuto_risposta = risposta.choices[0].message.content.strip()
+
+        try:
+            items = json.loads(contenuto_risposta)["groups"]
+        except (json.JSONDecodeError, KeyError) as e:
+            print(f"Errore nel parsing del JSON: {e}")
+            print("Contenuto grezzo:", contenuto_risposta)
+            items = []
+
+        sent = {self._normalize_group_id(group): group for group, text in chunk}
+        matched = {}
+        unrecognized = []
+        # first every item whose id is recognized, then the others by position, only into slots still free
+        for position, item in enumerate(items):
+            group = sent.get(self._normalize_group_id(item.get('Group', '')))
+            if group is not None and group not in matched:
+                item['Group'] = group
+                matched[group] = item
+            elif group is None:
+                unrecognized.append((position, item))
+        for position, item in unrecognized:
+            if position < len(chunk) and chunk[position][0] not in matched:
+                item['Group'] = chunk[position][0]
+                matched[chunk[position][0]] = item
+
+        for group, text in chunk:
+            if group not in matched:
+                print(f"{group} mancante nella risposta, nuova richiesta singola.")
+                item = await self._classify_single(group, text, sem)
+                if item is not None:
+                    matched[group] = item
+
+        return [matched[group] for group, text in chunk if group in matched]
+
+    async def _classify_single(self, group, text, sem):
+        """
+        Classifies a single group with `_annotation_messages`; used for the groups missing from a packed response.
+
+        Returns the `{Group, Category, Reason}` object, or `None` if the response could not be parsed.
+        """
+
+        async with sem:
+            risposta = await self._achat_with_retry(
+                model=self.model_name,
+                messages=self._annotation_messages(group, text),
+                temperature=0.2,
+                response_format=ANNOTATION_FORMAT
+            )
+        contenuto_risposta = risposta.choices[0].message.content.strip()
+
+        try:
+            item = json.loads(contenuto_risposta)
+        except json.JSONDecodeError as e:
+            print(f"Errore nel parsing del JSON: {e}")
+            print("Contenuto grezzo:", contenuto_risposta)
+            return None
+        item['Group'] = group
+        return item
+
+    @staticmethod
+    def _normalize_group_id(group):
+        # "Group 3", "group 3" and "3" all refer to the same group
+        group = str(group).strip()
+        if group.lower().startswith('group'):
+            group = group[len('group'):].strip()
+        return group
+
+    async def _classify_groups(self, diz_groups):
+        """
+        Runs `_classify_chunk` concurrently for every chunk of `diz_groups`, 
+        with at most `max_concurrency` requests open at once.
+        Results are returned in the same order as `diz_groups`.
+        """
+
+        results = await self._gather(lambda sem: [self._classify_chunk(chunk, sem) for chunk in self._chunk_groups(diz_groups)])
+        return [group for chunk_result in results for group in chunk_result]
+
     def annotations(self, element, file_name, output_json):
         """
         This method processes an XML file containing legal arguments, associates each argument with a semantic category, 
@@ -199,7 +755,8 @@ class AddAnnotations:
 
         Steps:
         1. **Group Aggregation**: Extracts groups from the XML element based on the `Group` attribute and aggregates the text for each group.
-        2. **Classification**: Sends the aggregated text of each group to an AI model to classify into categories:
+        If a `semantic_cache` is configured, groups similar to already classified ones reuse the cached category.
+        2. **Classification**: Sends the aggregated texts to an AI model, several groups per request, to classify into categories:
         - Historical, Textual, Structural, Prudential, Doctrinal, Ethical, or None.
         3. **Mapping**: Maps group IDs to their abbreviated category names (e.g., "HIS" for Historical Arguments).
         4. **XML Update**: Adds a `Category` attribute to XML elements based on the classification results.
@@ -215,95 +772,214 @@ class AddAnnotations:
         - A JSON file summarizing the AI classifications.
         """
 
-        diz_groups = {}
-        unified_json = {"groups": []}  # JSON unificato
+        cache_key = self._cache_key('annotations', element)
+        diz_groups, group_elements = self._group_texts(element)
+
+        unified_json = self._load_cached(cache_key)
+        if unified_json is None:
+            cached = self._empty_groups(diz_groups)
+            if self.semantic_cache is not None:
+                for group, text in diz_groups.items():
+                    if group in cached:
+                        continue
+                    entry = self.semantic_cache.lookup(text)
+                    if entry is not None:
+                        cached[group] = {"Group": group, "Category": entry["Category"], "Reason": entry["Reason"]}
+                print(f"{len(cached)}/{len(diz_groups)} groups found in the semantic cache or without text.")
+
+            to_classify = {group: text for group, text in diz_groups.items() if group not in cached}
+            classified = {}
+            if to_classify:
+                classified = {item.get('Group'): item for item in self._run(self._classify_groups(to_classify))}
+
+            if self.semantic_cache is not None and classified:
+                for group, item in classified.items():
+                    if group in to_classify:
+                        self.semantic_cache.add(to_classify[group], item.get('Category'), item.get('Reason'))
+                self.semantic_cache.save()
+
+            unified_json = {"groups": [cached.get(group) or classified[group] for group in diz_groups if group in cached or group in classified]}  # JSON unificato
+            # incomplete results (e.g. an unparsable response) are not cached, so that a rerun retries them
+            if len(unified_json["groups"]) == len(diz_groups):
+                self._save_cached(cache_key, unified_json)
+
+        self.save_json(unified_json, output_json)
+
+        self._write_annotations(element, unified_json, file_name, group_elements)
+
+    def annotations_batch(self, element, file_name, output_json, poll_interval=30):
+        """
+        Same as `annotations`, but submits all group classifications as a single job 
+        through the OpenAI Batch API instead of one chat request per group.
+        Batch jobs are cheaper and not subject to the per-minute rate limits, 
+        at the cost of latency: the method polls the job every `poll_interval` seconds until it completes.
 
-        for elem in element.iter():
-            if 'Group' in elem.attrib:
-                name = str(elem.attrib['Group']) 
-                if elem.attrib['Group'] == 'None':
-                    print(f'Skip element {elem.attrib} because is not assignet to any group')
-                else:
-                    if diz_groups.get(f'Group {name}') is None:
-                        diz_groups[f'Group {name}'] = elem.text
-                    else:
-                        diz_groups[f'Group {name}'] = diz_groups[f'Group {name}'] + '\n' + elem.text
-        
-        for group, text in diz_groups.items():
-            messaggi = [
-                {
-                    "role": "system",
-                    "content": (
-                        "You are an expert assistant in analyzing legal texts. "
-                        "Your task is to classify a supporting argument into one of the following subcategories, "
-                        "or to indicate that none is appropriate: \n"
-                        "- **Historical Arguments**: Interpretation based on the original intentions of the framers and ratifiers.\n"
-                        "- **Textual Arguments**: Based solely on the literal meaning of the words.\n"
-                        "- **Structural Arguments**: Analysis of the overall constitutional system and interactions among its parts.\n"
-                        "- **Prudential Arguments**: Evaluation of practical pros and cons and social consequences.\n"
-                        "- **Doctrinal Arguments**: Use of legal precedents to resolve new cases.\n"
-                        "- **Ethical Arguments**: Based on moral principles and shared societal values.\n\n"
-                        "If none of the categories is suitable, you may indicate that the text does not fit into any of them.\n\n"
-                        "Please return the result in the following JSON format:\n\n"
-                        "{\n"
-                        f"   \"Group\": \"Group {group}\",\n"
-                        "   \"Category\": \"[Name of Category or 'None']\",\n"
-                        "   \"Reason\": \"[Explanation for the classification]\"\n"
-                        "}\n"
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": (
-                        f"The following text is a supporting argument: {text}. "
-                        f"Group: {group}"
-                        "Analyze the content and identify the most relevant subcategory from the provided options, "
-                        "or indicate if none of the subcategories is appropriate. "
-                        "Please ensure the response is formatted strictly as JSON, following the example provided."
-                    )
+        Inputs:
+        - `element`: The root XML element containing legal arguments.
+        - `file_name`: The name of the output XML file.
+        - `output_json`: Path to save the JSON responses.
+        - `poll_interval`: Seconds to wait between two status checks of the batch job.
+
+        Outputs:
+        - An updated XML file with `Category` attributes added for each argument.
+        - A JSON file summarizing the AI classifications.
+        """
+
+        cache_key = self._cache_key('annotations', element)
+        diz_groups, group_elements = self._group_texts(element)
+
+        unified_json = self._load_cached(cache_key)
+        if unified_json is None:
+            unified_json = {"groups": []}
+
+            skipped = self._empty_groups(diz_groups)
+            to_classify = {group: text for group, text in diz_groups.items() if group not in skipped}
+            responses = {}
+            if to_classify:
+                responses = self._run_batch(to_classify, poll_interval)
+                if responses is None:
+                    return
+
+            # batch output order is not guaranteed, keep the document order of the groups
+            for group in diz_groups:
+                if group in skipped:
+                    unified_json["groups"].append(skipped[group])
+                elif group in responses:
+                    output_file, unified_json = self.parse_json_output(contenuto_risposta=responses[group], unified_json=unified_json, file_path=output_json, flush=False)
+                    if output_file is not None:
+                        # the response is keyed by `custom_id`, do not rely on the group id echoed by the model
+                        output_file['Group'] = group
+            if len(unified_json["groups"]) == len(diz_groups):
+                self._save_cached(cache_key, unified_json)
+
+        self.save_json(unified_json, output_json)
+
+        self._write_annotations(element, unified_json, file_name, group_elements)
+
+    def _run_batch(self, to_classify, poll_interval):
+        """
+        Submits one classification request per group of `to_classify` as an OpenAI batch job 
+        and waits for it, checking its status every `poll_interval` seconds.
+
+        Returns a dictionary mapping each group to the raw model output, or `None` if the job did not complete.
+        """
+
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', encoding='utf-8', delete=False) as batch_file:
+            for group, text in to_classify.items():
+                request = {
+                    "custom_id": group,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": self.model_name,
+                        "messages": self._annotation_messages(group, text),
+                        "temperature": 0.2,
+                        "response_format": ANNOTATION_FORMAT
+                    }
                 }
-            ]
+                batch_file.write(json.dumps(request, ensure_ascii=False) + '\n')
 
-            risposta = self.client.chat.completions.create(
-                model= self.model_name,
-                messages=messaggi,
-                temperature=0.2
-            )
-            response_content = risposta.choices[0].message.content.strip()
-            
-            output_file, unified_json = self.parse_json_output(contenuto_risposta=response_content, unified_json=unified_json, file_path=output_json)
-            
+        if self.client is None:
+            # retries are handled by `api_retry` only, not by the SDK
+            self.client = OpenAI(api_key=self.openai_api_key, http_client=self._http, max_retries=0)
+
+        try:
+            # read in memory, so that a retried upload sends the whole file again
+            with open(batch_file.name, 'rb') as f:
+                batch_data = f.read()
+        finally:
+            os.remove(batch_file.name)
+        input_file = self._api_call(self.client.files.create, file=('batch.jsonl', batch_data), purpose='batch')
+
+        batch = self._api_call(
+            self.client.batches.create,
+            input_file_id=input_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h'
+        )
+        print(f"Batch {batch.id} submitted with {len(to_classify)} requests.")
+
+        while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+            time.sleep(poll_interval)
+            batch = self._api_call(self.client.batches.retrieve, batch.id)
+
+        if batch.status != 'completed' or batch.output_file_id is None:
+            print(f"Errore: batch {batch.id} terminato con stato '{batch.status}'.")
+            return None
+
+        responses = {}
+        for line in self._api_call(self.client.files.content, batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            if result.get('error') or result['response']['status_code'] != 200:
+                print(f"Errore nella richiesta {result['custom_id']}: {result.get('error') or result['response']['body']}")
+                continue
+            responses[result['custom_id']] = result['response']['body']['choices'][0]['message']['content'].strip()
+        return responses
+
+    def _empty_groups(self, diz_groups):
+        """
+        Returns the classification of the groups without any text, recorded locally as `None` 
+        so that no request is sent (and billed) for them.
+        """
 
-        category_map = {
-            "Historical Arguments": "HIS",
-            "Textual Arguments": "TXT",
-            "Structural Arguments": "STRUCT",
-            "Prudential Arguments": "PRUD",
-            "Doctrinal Arguments": "DOCT",
-            "Ethical Arguments": "ETH",
-            "None": "None"
+        return {
+            group: {"Group": group, "Category": "None", "Reason": "The group has no text to classify."}
+            for group, text in diz_groups.items() if not text.strip()
         }
+
+    def _group_texts(self, element):
+        """
+        Aggregates the text of the XML elements by their `Group` attribute.
+        Elements assigned to group `None` are skipped, elements without text only count as members of their group.
+
+        Returns:
+        - `diz_groups`: A dictionary mapping `Group <id>` to the concatenated text of the group.
+        - `group_elements`: A dictionary mapping `Group <id>` to the XML elements (with an `ID`) of the group, 
+        so that categories can be written back without walking the tree again.
+        """
+
+        diz_groups = defaultdict(list)
+        group_elements = defaultdict(list)
+        for elem in self._GROUP_XPATH(element):
+            name = elem.attrib['Group']
+            if name == 'None':
+                print(f'Skip element {elem.attrib} because is not assignet to any group')
+            else:
+                key = f'Group {name}'
+                texts = diz_groups[key]
+                if elem.text and elem.text.strip():
+                    texts.append(elem.text)
+                if elem.tag != 'body' and 'ID' in elem.attrib:
+                    group_elements[key].append(elem)
+
+        # join once per group instead of concatenating strings sentence by sentence
+        diz_groups = {key: '\n'.join(texts) for key, texts in diz_groups.items()}
+        return diz_groups, group_elements
+
+    def _write_annotations(self, element, unified_json, file_name, group_elements):
+        """
+        Maps the classified groups in `unified_json` to their abbreviated category names, 
+        adds the `Category` attribute to the elements of each group (`group_elements`, from `_group_texts`) and saves the updated XML file 
+        in the `demosthenes_dataset_annotated` directory.
+        """
+
         group_map = {
-            group['Group']: category_map.get(group['Category'], "Unknown")
+            group['Group']: self.CATEGORY_MAP.get(group['Category'], "Unknown")
             for group in unified_json["groups"]
         }
 
 
-        for elem in element.iter():
-            if elem.tag != 'body' and 'ID' in elem.attrib:
-                if 'Group' in elem.attrib:
-                    group_id = 'Group '+ elem.attrib['Group']
-           
-                    if group_id in group_map:
-                        elem.set('Category', str(group_map[group_id]))
-        tree = ET.ElementTree(element)
+        for group_id, category in group_map.items():
+            for elem in group_elements.get(group_id, []):
+                elem.set('Category', str(category))
+        tree = element.getroottree()
         output_directory = 'demosthenes_dataset_annotated'
         os.makedirs(output_directory, exist_ok=True)
         tree.write(f'demosthenes_dataset_annotated/{file_name}', encoding="utf-8", xml_declaration=True)
         print(f"Updated XML file saved as 'demosthenes_dataset_annotated/{file_name}'.")
 
-    
-
 
     def call_unifypar_struct(self, name, output_json):
         tree = ET.parse(f'demosthenes_dataset/{name}')
@@ -315,6 +991,12 @@ class AddAnnotations:
         tree = ET.parse(f'demosthenes_dataset_group/{name}')
         root = tree.getroot()
         self.annotations(root, name, output_json)
+
+
+    def call_annotations_batch(self, name, output_json):
+        tree = ET.parse(f'demosthenes_dataset_group/{name}')
+        root = tree.getroot()
+        self.annotations_batch(root, name, output_json)
         
 
 
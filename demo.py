@@ -1,10 +1,52 @@
 from annotator import AddAnnotations
+from rate_limiter import RateLimiter
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import os
 
 
 key = 'put here your API key'
 model_GPT = 'gpt-4o'
-filename = "A2008_Commission of the European Communities v Salzgitter AG.xml"
+input_directory = 'demosthenes_dataset'
+max_workers = 16
 
-annotator = AddAnnotations(model_name=model_GPT, openai_api_key=key)
-annotator.call_unifypar_struct(name=filename, output_json=f'output_group/{filename}.json')
-annotator.call_annotations(name=filename, output_json=f'output_annotations/{filename}.json')
\ No newline at end of file
+# shared by all the files, so that the whole run stays under the account limits
+rate_limiter = RateLimiter(max_requests_per_minute=500, max_tokens_per_minute=200000)
+
+# one annotator per worker thread, reused for all the files of that thread: it keeps its own event loop
+# and async client, so the keep-alive connections are reused across steps and files
+local = threading.local()
+annotators = []
+
+
+def get_annotator():
+    if not hasattr(local, 'annotator'):
+        local.annotator = AddAnnotations(model_name=model_GPT, openai_api_key=key, max_concurrency=4, rate_limiter=rate_limiter)
+        annotators.append(local.annotator)
+    return local.annotator
+
+
+def process_one(filename):
+    # errors are caught per file, so that one failing file does not stop the others
+    try:
+        annotator = get_annotator()
+        annotator.call_unifypar_struct(name=filename, output_json=f'output_group/{filename}.json')
+        annotator.call_annotations(name=filename, output_json=f'output_annotations/{filename}.json')
+        return True
+    except Exception as e:
+        print(f"Errore nel file {filename}: {e!r}")
+        return False
+
+
+# the pipeline is bound by network I/O to the API, threads are enough to overlap the files
+filenames = [f for f in os.listdir(input_directory) if f.endswith('.xml')]
+with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    results = list(executor.map(process_one, filenames))
+
+for annotator in annotators:
+    annotator.close()
+
+failed = [filename for filename, ok in zip(filenames, results) if not ok]
+print(f"{len(filenames) - len(failed)}/{len(filenames)} file elaborati con successo.")
+for filename in failed:
+    print(f"Fallito: {filename}")
@@ -0,0 +1,83 @@
+import asyncio
+import threading
+import time
+
+
+
+class RateLimiter:
+    """
+    This class is a token bucket that keeps the requests sent to the OpenAI API under the
+    requests-per-minute (RPM) and tokens-per-minute (TPM) limits of the account, so that
+    requests are delayed on the client side instead of being rejected with a 429 error.
+
+    Both capacities refill continuously at `max_requests_per_minute / 60` and
+    `max_tokens_per_minute / 60` units per second. The `x-ratelimit-remaining-*` headers
+    returned by the API can be fed to `update_from_headers` to resynchronize the buckets
+    with the limits seen by the server (e.g. when other processes share the same key).
+
+    The same instance can be used from threads (`acquire`) and from coroutines (`acquire_async`).
+    """
+
+
+    def __init__(self, max_requests_per_minute=500, max_tokens_per_minute=200000):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_requests = max_requests_per_minute
+        self.available_tokens = max_tokens_per_minute
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.available_requests = min(self.max_requests_per_minute, self.available_requests + elapsed * self.max_requests_per_minute / 60)
+        self.available_tokens = min(self.max_tokens_per_minute, self.available_tokens + elapsed * self.max_tokens_per_minute / 60)
+        self.last_update = now
+
+    def _try_acquire(self, tokens):
+        """
+        Consumes one request and `tokens` tokens if both are available.
+        Returns 0 on success, otherwise the number of seconds to wait before trying again.
+        """
+
+        # a request larger than the whole TPM budget would never fit, cap it to the bucket size
+        tokens = min(tokens, self.max_tokens_per_minute)
+        with self.lock:
+            self._refill()
+            if self.available_requests >= 1 and self.available_tokens >= tokens:
+                self.available_requests -= 1
+                self.available_tokens -= tokens
+                return 0
+            missing_requests = max(0, 1 - self.available_requests)
+            missing_tokens = max(0, tokens - self.available_tokens)
+            return max(missing_requests * 60 / self.max_requests_per_minute, missing_tokens * 60 / self.max_tokens_per_minute)
+
+    def acquire(self, tokens):
+        """
+        Blocks the calling thread until one request and `tokens` tokens are available.
+        """
+
+        while (wait := self._try_acquire(tokens)) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens):
+        """
+        Same as `acquire`, but waits without blocking the event loop.
+        """
+
+        while (wait := self._try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+    def update_from_headers(self, headers):
+        """
+        Lowers the available capacity to the remaining requests and tokens reported by the API.
+        """
+
+        with self.lock:
+            self._refill()
+            remaining_requests = headers.get('x-ratelimit-remaining-requests')
+            remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+            if remaining_requests is not None:
+                self.available_requests = min(self.available_requests, float(remaining_requests))
+            if remaining_tokens is not None:
+                self.available_tokens = min(self.available_tokens, float(remaining_tokens))
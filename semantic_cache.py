@@ -0,0 +1,78 @@
+import json
+import os
+
+try:
+    import faiss
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    faiss = None
+    SentenceTransformer = None
+
+
+
+class SemanticCache:
+    """
+    This class is a local cache of group classifications, keyed on the meaning of the group text
+    rather than on its exact content. Legal documents share a lot of boilerplate (recitals, standard
+    formulas), so groups that paraphrase an already classified group reuse its category instead of
+    issuing a new request to the model.
+
+    Texts are embedded with a SentenceTransformer model and stored in a FAISS inner-product index;
+    with normalized embeddings the inner product is the cosine similarity. A lookup is a hit when
+    the most similar cached text has a similarity of at least `threshold`.
+
+    Files saved in `cache_dir`:
+    - `index.faiss`: The FAISS index with one embedding per cached text.
+    - `cache.json`: The `Category` and `Reason` of each row of the index.
+
+    Requires the optional dependencies `sentence-transformers` and `faiss-cpu`.
+    """
+
+
+    def __init__(self, cache_dir='semantic_cache', threshold=0.87, model_name='all-MiniLM-L6-v2'):
+        if faiss is None or SentenceTransformer is None:
+            raise ImportError("SemanticCache requires 'sentence-transformers' and 'faiss-cpu' to be installed.")
+
+        self.cache_dir = cache_dir
+        self.threshold = threshold
+        self.model = SentenceTransformer(model_name)
+
+        self.index_path = os.path.join(cache_dir, 'index.faiss')
+        self.entries_path = os.path.join(cache_dir, 'cache.json')
+        if os.path.exists(self.index_path) and os.path.exists(self.entries_path):
+            self.index = faiss.read_index(self.index_path)
+            with open(self.entries_path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+        else:
+            self.index = faiss.IndexFlatIP(self.model.get_sentence_embedding_dimension())
+            self.entries = []
+
+    def _encode(self, text):
+        return self.model.encode(text, normalize_embeddings=True).astype('float32')
+
+    def lookup(self, text):
+        """
+        Returns the cached `{Category, Reason}` entry of the text most similar to `text`,
+        or `None` if the cache is empty or no cached text is similar enough.
+        """
+
+        if self.index.ntotal == 0:
+            return None
+        D, I = self.index.search(self._encode(text)[None], 1)
+        if D[0, 0] >= self.threshold:
+            return self.entries[I[0, 0]]
+        return None
+
+    def add(self, text, category, reason):
+        """
+        Adds the classification of `text` to the cache. Call `save` to persist it on disk.
+        """
+
+        self.index.add(self._encode(text)[None])
+        self.entries.append({"Category": category, "Reason": reason})
+
+    def save(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        faiss.write_index(self.index, self.index_path)
+        with open(self.entries_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=4, ensure_ascii=False)